@@ -0,0 +1,45 @@
+import hashlib
+import json
+import os
+import time
+
+
+class FileCache:
+    """Cache disque des résultats SERP, un fichier JSON horodaté par clé."""
+
+    def __init__(self, directory=".cache/serp", ttl=86400):
+        self.directory = directory
+        self.ttl = ttl  # Durée de validité en secondes
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def make_key(*parts):
+        return hashlib.md5("|".join(str(part) for part in parts).encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key):
+        # Fichier absent, illisible ou au mauvais format : traité comme absent
+        try:
+            with open(self._path(key), encoding="utf-8") as f:
+                entry = json.load(f)
+            timestamp = entry["timestamp"]
+            data = entry["data"]
+            expired = time.time() - timestamp >= self.ttl
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+        # Entrée expirée
+        if expired:
+            return None
+        return data
+
+    def set(self, key, data):
+        # Écriture dans un fichier temporaire puis renommage, pour ne jamais
+        # laisser une entrée à moitié écrite
+        path = self._path(key)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"timestamp": time.time(), "data": data}, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
@@ -1,12 +1,53 @@
 import streamlit as st
 import requests
-import time
+import httpx
+import asyncio
 import base64
-import pandas as pd
+import copy
+import io
+import logging
 import re
+import unicodedata
+import orjson
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+from aiolimiter import AsyncLimiter
+from cache import FileCache
+
+logger = logging.getLogger(__name__)
+
+# Domaine d'une URL, sans le préfixe www.
+_DOMAIN_RE = re.compile(r'https?://(?:www\.)?([^/]+)')
+
+# Nombre maximal de connexions simultanées vers l'API
+MAX_CONNECTIONS = 200
+
+# Valeurs par défaut du nombre de requêtes en vol et du débit (requêtes/s)
+MAX_CONCURRENCY = 30
+RATE_LIMIT = 10
+
+# Nouvelles tentatives sur les erreurs réseau et les statuts HTTP transitoires
+MAX_RETRIES = 3
+BACKOFF_FACTOR = 0.5
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Un POST n'est pas idempotent : seul un 429 garantit que le lot n'a pas été
+# accepté, une 5xx pourrait créer (et facturer) les tâches une seconde fois
+POST_RETRY_STATUSES = {429}
+
+# Nombre maximal de tâches acceptées par l'API dans un même POST
+MAX_TASKS_PER_POST = 100
+
+# Code de statut DataForSEO d'une tâche créée avec succès
+TASK_CREATED = 20100
+
+# Paramètres de localisation des recherches
+LOCATION = "Paris,Ile-de-France,France"
+LANGUAGE = "fr"
 
 class DataForSEOAPI:
-    def __init__(self, username, password):
+    def __init__(self, username, password, max_concurrency=MAX_CONCURRENCY, rate_limit=RATE_LIMIT):
         self.username = username
         self.password = password
         auth = base64.b64encode(f"{username}:{password}".encode()).decode()
@@ -14,146 +55,302 @@ class DataForSEOAPI:
             'Authorization': f'Basic {auth}',
             'Content-Type': 'application/json'
         }
+        self.max_concurrency = max_concurrency
+        self.rate_limit = rate_limit
+        self.client = None
+        self.semaphore = None
+        self.limiter = None
+    
+    def for_run(self, max_concurrency=None, rate_limit=None):
+        # Copie propre à une recherche, avec ses propres limites : l'instance
+        # mise en cache est partagée entre les sessions Streamlit et ne porte
+        # jamais de client ouvert. La connexion n'est ouverte qu'en entrant
+        # dans le bloc async with de la copie
+        api = copy.copy(self)
+        if max_concurrency is not None:
+            api.max_concurrency = max_concurrency
+        if rate_limit is not None:
+            api.rate_limit = rate_limit
+        return api
+    
+    async def __aenter__(self):
+        # Créés ici car liés à la boucle asyncio de la recherche en cours
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.limiter = AsyncLimiter(self.rate_limit, 1)
+        
+        # Un seul client partagé par toutes les villes d'une même recherche :
+        # les connexions TCP/TLS vers l'API sont réutilisées d'un appel à l'autre
+        transport = httpx.AsyncHTTPTransport(
+            http2=True,
+            limits=httpx.Limits(
+                max_connections=MAX_CONNECTIONS,
+                max_keepalive_connections=MAX_CONNECTIONS
+            ),
+            retries=MAX_RETRIES  # Erreurs de connexion uniquement
+        )
+        self.client = httpx.AsyncClient(headers=self.headers, transport=transport, timeout=60)
+        return self
+    
+    async def __aexit__(self, *exc_info):
+        await self.client.aclose()
+        self.client = None
+    
+    async def _request(self, method, endpoint, retry_statuses=RETRY_STATUSES, **kwargs):
+        # Backoff exponentiel sur les statuts transitoires (429 et 5xx par défaut)
+        for attempt in range(MAX_RETRIES + 1):
+            # Limite le nombre de requêtes en vol et le débit pour éviter les 429
+            async with self.semaphore, self.limiter:
+                response = await self.client.request(method, endpoint, **kwargs)
+            if response.status_code not in retry_statuses or attempt == MAX_RETRIES:
+                return response
+            await asyncio.sleep(BACKOFF_FACTOR * 2 ** attempt)
+    
+    @staticmethod
+    def make_task(query, tag, location=LOCATION, language=LANGUAGE, depth=100):
+        # Structure correcte d'une tâche ; le tag est renvoyé tel quel par l'API
+        return {
+            "keyword": query,
+            "location_name": location,
+            "language_name": language,
+            "device": "desktop",
+            "os": "windows",
+            "depth": depth,  # Assurez-vous que depth <= 200
+            "tag": tag,
+        }
+    
+    async def _post_batch(self, endpoint, payloads):
+        response = await self._request(
+            "POST", endpoint, retry_statuses=POST_RETRY_STATUSES, content=orjson.dumps(payloads)
+        )
+        response.raise_for_status()  # Lever une erreur pour un statut HTTP 4xx/5xx
+        return orjson.loads(response.content)
     
-    def post_task(self, query, location="Paris,Ile-de-France,France", language="fr"):
+    async def post_tasks(self, payloads):
         endpoint = "https://api.dataforseo.com/v3/serp/google/organic/task_post"
         
-        # Structure correcte de la requête
-        payload = [
-            {
-                "keyword": query,
-                "location_name": location,
-                "language_name": language,
-                "device": "desktop",
-                "os": "windows",
-                "depth": max_results,  # Assurez-vous que max_results <= 200
-            }
+        # Envoi par lots de MAX_TASKS_PER_POST tâches ; un lot en erreur est
+        # renvoyé sous forme d'exception sans bloquer les autres
+        batches = [
+            payloads[i:i + MAX_TASKS_PER_POST]
+            for i in range(0, len(payloads), MAX_TASKS_PER_POST)
         ]
-        response = requests.post(
-            endpoint,
-            json=payload,
-            headers=self.headers
+        return await asyncio.gather(
+            *(self._post_batch(endpoint, batch) for batch in batches),
+            return_exceptions=True
         )
-        response.raise_for_status()  # Lever une erreur pour un statut HTTP 4xx/5xx
-        return response.json()
 
     
-    def get_results(self, task_id):
+    async def get_results(self, task_id):
         endpoint = f"https://api.dataforseo.com/v3/serp/google/organic/task_get/{task_id}"
         try:
-            response = requests.get(endpoint, headers=self.headers)
-            return response.json()
+            response = await self._request("GET", endpoint)
+            response.raise_for_status()  # Une erreur HTTP laisse la tâche en attente
+            return orjson.loads(response.content)
         except Exception as e:
             return {"error": str(e)}
 
 
-def scrape_google_urls(query, city, max_results=200, progress_bar=None):
-    username = st.secrets["DATAFORSEO_USERNAME"]
-    password = st.secrets["DATAFORSEO_PASSWORD"]
-    api = DataForSEOAPI(username, password)
+    async def tasks_ready(self):
+        endpoint = "https://api.dataforseo.com/v3/serp/google/organic/tasks_ready"
+        try:
+            response = await self._request("GET", endpoint)
+            response.raise_for_status()  # Une erreur HTTP laisse la tâche en attente
+            return orjson.loads(response.content)
+        except Exception as e:
+            return {"error": str(e)}
+
+
+def normalize_city(city):
+    # Casse et accents ignorés : "Chambéry" et "chambery" sont la même ville.
+    # Seuls les signes diacritiques sont retirés, les autres caractères
+    # (cyrillique, japonais, Œ...) sont conservés
+    decomposed = unicodedata.normalize('NFKD', city)
+    key = ''.join(c for c in decomposed if not unicodedata.combining(c)).casefold()
+    return key or city.casefold()
+
+
+def parse_cities(cities_text):
+    # Une ville par ligne, doublons supprimés en conservant l'ordre et la
+    # première orthographe saisie
+    unique_cities = {}
+    for city in (line.strip() for line in cities_text.split("\n")):
+        if city:
+            unique_cities.setdefault(normalize_city(city), city)
+    return list(unique_cities.values())
+
+
+@st.cache_resource
+def get_api():
+    return DataForSEOAPI(st.secrets["DATAFORSEO_USERNAME"], st.secrets["DATAFORSEO_PASSWORD"])
+
+
+def extract_organic_results(get_response, query, city, max_results):
+    # Vérification de la structure de la réponse
+    if "tasks" not in get_response or not get_response["tasks"]:
+        logger.warning("Structure de réponse inattendue pour %s: %s", city, get_response)
+        return None
     
-    # Création de la tâche
-    post_response = api.post_task(f"{query} {city}", depth=max_results)
+    task = get_response["tasks"][0]
+    if not task.get("result"):
+        return None
     
-    # Débogage
-    st.write("Réponse POST de l'API:", post_response)
+    # Extraction des résultats organiques en un seul passage, arrêtée dès que
+    # le nombre de résultats demandés est atteint
+    organic_results = []
+    items = (item for result in task["result"] for item in result.get("items") or [])
+    for organic_item in items:
+        if len(organic_results) >= max_results:
+            break
+        if organic_item.get("type") == "organic":
+            organic_results.append({
+                "position": organic_item.get("rank_absolute", 0),
+                "title": organic_item.get("title", ""),
+                "url": organic_item.get("url", ""),
+                "description": organic_item.get("description", ""),
+                "city": city,
+                "query": query
+            })
     
-    if "tasks" not in post_response or not post_response["tasks"]:
-        st.error(f"Erreur dans la création de la tâche: {post_response}")
-        return None
+    return organic_results
+
+
+async def scrape_google_urls(query, cities, max_results=200, progress_bar=None, cache=None, force_refresh=False,
+                             max_concurrency=MAX_CONCURRENCY, rate_limit=RATE_LIMIT, debug=False):
+    results_by_city = {}
     
-    task_id = post_response["tasks"][0]["id"]
+    # Les villes déjà en cache ne sont pas renvoyées à l'API ; la clé utilise
+    # la forme normalisée de la ville pour que "Chambéry" et "chambery"
+    # partagent la même entrée
+    cache_keys = {
+        city: FileCache.make_key(query, normalize_city(city), LOCATION, LANGUAGE, max_results)
+        for city in cities
+    }
+    if cache and not force_refresh:
+        for city in cities:
+            cached_results = cache.get(cache_keys[city])
+            if cached_results is not None:
+                results_by_city[city] = cached_results
     
-    # Paramètres pour la récupération des résultats
-    max_attempts = 15  # Augmenté pour donner plus de temps à l'API
-    wait_time = 45  # Temps d'attente initial
+    cities_to_fetch = [city for city in cities if city not in results_by_city]
+    if progress_bar:
+        progress_bar.progress(len(results_by_city) / len(cities))
     
-    # Attente et récupération des résultats
-    for attempt in range(max_attempts):
-        time.sleep(wait_time)
-        
-        # Après la première tentative, augmenter le temps d'attente
-        if attempt > 0:
-            wait_time = 30
-        
-        # Mise à jour de la barre de progression si fournie
-        if progress_bar:
-            progress_bar.progress((attempt + 1) / max_attempts)
+    async with get_api().for_run(max_concurrency, rate_limit) as api:
+        # Création de toutes les tâches avant de récupérer le moindre résultat
+        payloads = [
+            DataForSEOAPI.make_task(f"{query} {city}", tag=city, depth=max_results)
+            for city in cities_to_fetch
+        ]
+        post_responses = await api.post_tasks(payloads) if payloads else []
         
-        # Récupérer les résultats
-        get_response = api.get_results(task_id)
+        pending = {}  # task_id -> ville
+        for post_response in post_responses:
+            if isinstance(post_response, Exception):
+                st.error(f"Erreur dans la création des tâches: {post_response}")
+                continue
+            
+            # Débogage
+            logger.debug("Réponse POST de l'API: %s", post_response)
+            if debug:
+                st.write("Réponse POST de l'API:", post_response)
+            
+            if "tasks" not in post_response or not post_response["tasks"]:
+                st.error(f"Erreur dans la création des tâches: {post_response}")
+                continue
+            
+            # Chaque tâche est rattachée à sa ville grâce au tag
+            for task in post_response["tasks"]:
+                city = (task.get("data") or {}).get("tag")
+                if task.get("status_code") != TASK_CREATED or city is None:
+                    st.error(f"Erreur dans la création de la tâche pour {city}: {task.get('status_message')}")
+                    continue
+                pending[task["id"]] = city
         
-        # Débogage
-        st.write("Structure complète de la réponse:")
-        st.json(get_response)
+        # Paramètres pour la récupération des résultats
+        max_attempts = 10  # Environ 4 min 40 s d'attente cumulée entre les 10 interrogations
         
-        # Vérification de la structure de la réponse
-        if "tasks" in get_response and get_response["tasks"]:
-            task = get_response["tasks"][0]
-            if "result" in task:
-                results = task.get("result", [])
-                for result in results:
-                    if "items" in result:
-                        for organic_item in result["items"]:
-                            if organic_item.get("type") == "organic":
-                                organic_results.append({
-                                    "position": organic_item.get("rank_absolute", 0),
-                                    "title": organic_item.get("title", ""),
-                                    "url": organic_item.get("url", ""),
-                                    "description": organic_item.get("description", "")
-                                })
+        # On ne récupère que les tâches signalées comme terminées par l'API
+        for attempt in range(max_attempts):
+            if not pending:
+                break
+            
+            ready_response = await api.tasks_ready()
+            ready_ids = [
+                ready_task["id"]
+                for task in ready_response.get("tasks") or []
+                for ready_task in task.get("result") or []
+                if ready_task.get("id") in pending
+            ]
+            
+            get_responses = await asyncio.gather(*(api.get_results(task_id) for task_id in ready_ids))
+            for task_id, get_response in zip(ready_ids, get_responses):
+                # En cas d'erreur réseau, la tâche reste en attente
+                if "error" in get_response:
+                    continue
                 
-                # Extraire les résultats organiques
-                for item in task["result"]:
-                    if "items" in item and item["items"]:
-                        for organic_item in item["items"]:
-                            if organic_item["type"] == "organic":
-                                organic_results.append({
-                                    "position": organic_item.get("rank_absolute", ""),
-                                    "title": organic_item.get("title", ""),
-                                    "url": organic_item.get("url", ""),
-                                    "description": organic_item.get("description", ""),
-                                    "city": city,
-                                    "query": query
-                                })
+                city = pending.pop(task_id)
                 
-                return organic_results[:max_results]  # Limiter au nombre de résultats demandés
-        else:
-            st.write("Structure de réponse inattendue")
+                # Débogage
+                logger.debug("Réponse task_get pour %s (%s): %s", city, task_id, get_response)
+                if debug:
+                    st.write(f"Structure complète de la réponse pour {city}:")
+                    st.json(get_response)
+                
+                results_by_city[city] = extract_organic_results(get_response, query, city, max_results)
+                if cache and results_by_city[city] is not None:
+                    cache.set(cache_keys[city], results_by_city[city])
+                
+                if progress_bar:
+                    progress_bar.progress(len(results_by_city) / len(cities))
+            
+            # Pas d'attente après la dernière interrogation
+            if pending and attempt < max_attempts - 1:
+                # Backoff exponentiel : 5s, 7.5s, 11s... plafonné à 60s
+                wait_time = min(60, 5 * (1.5 ** attempt))
+                await asyncio.sleep(wait_time)
     
-    # Si on arrive ici, c'est qu'on n'a pas réussi à récupérer les résultats
-    st.error("Impossible de récupérer les résultats après plusieurs tentatives")
-    return None
-
-
-def extract_domain(url):
-    match = re.search(r'https?://(?:www\.)?([^/]+)', url)
-    if match:
-        return match.group(1)
-    return url
+    # Si des tâches restent en attente, on n'a pas réussi à récupérer leurs résultats
+    for city in pending.values():
+        st.error(f"Impossible de récupérer les résultats pour {city} après plusieurs tentatives")
+    
+    # Résultats renvoyés dans l'ordre de saisie des villes
+    return {city: results_by_city.get(city) for city in cities}
 
 
-def process_results(results):
-    if not results:
+def process_results(results_by_city):
+    results_by_city = {city: results for city, results in results_by_city.items() if results}
+    if not results_by_city:
         return None
     
-    # Création du DataFrame
-    df = pd.DataFrame(results)
+    # Un seul DataFrame pour toutes les villes, construit à partir des
+    # listes de dictionnaires de chaque ville (qui portent déjà la ville)
+    df = pd.DataFrame.from_records(chain.from_iterable(results_by_city.values()))
     
-    # Ajout de la colonne domaine
-    df['domain'] = df['url'].apply(extract_domain)
+    # Ajout de la colonne domaine (extraction vectorisée, l'URL est conservée
+    # telle quelle si elle ne correspond pas au motif)
+    df['domain'] = df['url'].str.extract(_DOMAIN_RE, expand=False).fillna(df['url'])
     
     return df
 
 
+def export_results(df):
+    # Les exports sont écrits directement en octets, sans chaîne intermédiaire
+    csv_buffer = io.BytesIO()
+    df.to_csv(csv_buffer, index=False, encoding='utf-8')
+    
+    # Parquet : format colonnaire compressé, bien plus léger pour de nombreuses villes
+    parquet_buffer = io.BytesIO()
+    df.to_parquet(parquet_buffer, index=False)
+    
+    return csv_buffer.getvalue(), parquet_buffer.getvalue()
+
+
 def main():
     st.title("🔍 Scraper Google Search via DataForSEO (Standard Queue)")
     
     # Test API si coché
     if st.sidebar.checkbox("Tester connexion API"):
-        username = st.secrets["DATAFORSEO_USERNAME"]
-        password = st.secrets["DATAFORSEO_PASSWORD"]
-        api = DataForSEOAPI(username, password)
+        api = get_api()
         
         test_response = requests.get(
             "https://api.dataforseo.com/v3/merchant/account_info", 
@@ -174,7 +371,26 @@ def main():
         st.write("Liste des villes (une par ligne)")
         cities_text = st.text_area("", value="Paris", height=120, help="Entrez une ville par ligne")
     
-    cities = [city.strip() for city in cities_text.split("\n") if city.strip()]
+    cities = parse_cities(cities_text)
+    
+    # Cache des résultats
+    cache_ttl_hours = st.sidebar.number_input(
+        "Durée de validité du cache (heures)", min_value=0, value=24,
+        help="Les recherches déjà effectuées pendant cette durée ne sont pas refacturées"
+    )
+    force_refresh = st.sidebar.checkbox("Forcer le rafraîchissement", help="Ignorer le cache pour cette recherche")
+    
+    # Limites d'appels à l'API
+    max_concurrency = st.sidebar.slider(
+        "Requêtes simultanées", 1, 100, MAX_CONCURRENCY,
+        help="Nombre maximal de requêtes en cours vers l'API"
+    )
+    rate_limit = st.sidebar.slider(
+        "Requêtes par seconde", 1, 30, RATE_LIMIT,
+        help="Débit maximal de requêtes envoyées à l'API"
+    )
+    
+    debug = st.sidebar.checkbox("Afficher les réponses brutes de l'API", value=False)
     
     # Nombre de résultats par ville
     st.write("Nombre de résultats à récupérer par ville")
@@ -186,28 +402,36 @@ def main():
             st.error("Veuillez entrer un terme de recherche et au moins une ville")
             return
         
-        all_results = []
         progress_bar = st.progress(0)
+        st.write(f"Recherche en cours pour {len(cities)} ville(s) (Peut prendre jusqu'à 5 minutes)")
         
-        for i, city in enumerate(cities):
-            st.write(f"Recherche en cours pour : {query} {city} (Peut prendre jusqu'à 5 minutes)")
-            results = scrape_google_urls(query, city, max_results, progress_bar)
-            
-            if results:
-                all_results.extend(results)
-                progress_bar.progress((i + 1) / len(cities))
-            else:
+        results_by_city = asyncio.run(scrape_google_urls(
+            query, cities, max_results, progress_bar,
+            cache=FileCache(ttl=cache_ttl_hours * 3600),
+            force_refresh=force_refresh,
+            max_concurrency=max_concurrency,
+            rate_limit=rate_limit,
+            debug=debug
+        ))
+        
+        for city, results in results_by_city.items():
+            if not results:
                 st.warning(f"Aucun résultat trouvé pour {query} {city}")
         
-        if all_results:
-            df = process_results(all_results)
-            
-            # Affichage des résultats
-            st.success(f"{len(all_results)} résultats récupérés au total")
-            st.dataframe(df)
+        df = process_results(results_by_city)
+        if df is not None:
+            # Les exports CSV et Parquet sont générés en arrière-plan pendant
+            # l'affichage des résultats ; le DataFrame n'est plus modifié
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                export_future = executor.submit(export_results, df)
+                
+                # Affichage des résultats
+                st.success(f"{len(df)} résultats récupérés au total")
+                st.dataframe(df)
+                
+                with st.spinner("Préparation des fichiers à télécharger..."):
+                    csv, parquet = export_future.result()
             
-            # Export CSV
-            csv = df.to_csv(index=False).encode('utf-8')
             st.download_button(
                 "Télécharger les résultats (CSV)",
                 csv,
@@ -215,6 +439,13 @@ def main():
                 "text/csv",
                 key='download-csv'
             )
+            st.download_button(
+                "Télécharger les résultats (Parquet)",
+                parquet,
+                f"resultats_{query.replace(' ', '_')}.parquet",
+                "application/vnd.apache.parquet",
+                key='download-parquet'
+            )
         else:
             st.error("Aucun résultat trouvé. Base toi sur cette docs pour essayer de corriger l'erreur : https://docs.dataforseo.com/v3/serp/google/organic/task_get/regular/?bash&_gl=1*12qovjf*_up*MQ..*_ga*MTcwODY0ODgwNC4xNzQzNDE5OTMx*_ga_T5NKP5Y695*MTc0MzQxOTkzMS4xLjEuMTc0MzQxOTk2OS4wLjAuMTA2MTE2MDU2MA..")
 